@@ -8,34 +8,116 @@ V21 - The Original V11 Code, Repaired
 import requests
 import folium
 from folium import plugins
+from IPython import get_ipython
 from IPython.display import display, HTML, clear_output
 import ipywidgets as widgets
 from geopy.geocoders import Nominatim
 import time
 import threading
-from google.colab import output # الواجهة الصحيحة
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from array import array
+from collections import OrderedDict, deque
+try:
+    from google.colab import output # الواجهة الصحيحة
+except ImportError:
+    output = None # خارج Colab: تشغيل خدمة HTTP بدلاً من الواجهة
 import json # لإرسال النتائج بشكل آمن
 
 # --- الوظائف المساعدة (من V11) ---
 
-def get_address_from_coords(lat, lon):
-    """Get address from coordinates"""
+NOMINATIM_MIN_INTERVAL = 1.0 # Nominatim usage policy: one request per second
+OSRM_BASE_URL = 'http://router.project-osrm.org' # خادم OSRM العام (تجريبي)
+OSRM_PUBLIC_MIN_INTERVAL = 1.0 # سياسة الخادم العام: ~طلب واحد في الثانية
+ADDRESS_CACHE_SIZE = 4096
+
+_address_cache = OrderedDict()
+_address_cache_lock = threading.Lock()
+_nominatim_lock = threading.Lock()
+_last_nominatim_call = 0.0
+
+# كل thread له Session خاص لـ OSRM (requests.Session غير مضمون مع threads)،
+# لكن مجمّع اتصالات OSRM (urllib3، آمن مع threads) مشترك، فالاتصال الذي
+# يفتحه الجلب المسبق يُعاد استخدامه في طلب المسار الفعلي (keep-alive)
+_osrm_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+_thread_local = threading.local()
+
+
+def _get_osrm_session():
+    """This thread's OSRM session (on the shared connection pool)"""
+    session = getattr(_thread_local, 'osrm_session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('http://', _osrm_adapter)
+        session.mount('https://', _osrm_adapter)
+        _thread_local.osrm_session = session
+    return session
+
+
+# عميل Nominatim واحد مشترك (يبقي اتصاله مفتوحاً للطلب التالي)؛ الاستدعاءات
+# متسلسلة أصلاً بحد الطلب في الثانية، فالقفل لا يكلّف شيئاً ويجعل المشاركة آمنة
+_geolocator = Nominatim(user_agent="ev_route_planner_v21")
+_geolocator_lock = threading.Lock()
+
+
+def _wait_for_nominatim_slot(still_wanted=None):
+    """Block until the next Nominatim request is allowed (shared by all threads).
+
+    Returns False without using the slot if still_wanted() turns false while
+    waiting, so abandoned speculative lookups don't delay real ones.
+    """
+    global _last_nominatim_call
+    with _nominatim_lock:
+        delay = NOMINATIM_MIN_INTERVAL - (time.monotonic() - _last_nominatim_call)
+        if delay > 0:
+            time.sleep(delay)
+        if still_wanted is not None and not still_wanted():
+            return False
+        _last_nominatim_call = time.monotonic()
+        return True
+
+
+def get_address_from_coords(lat, lon, still_wanted=None):
+    """Get address from coordinates (cached, rate limited).
+
+    Returns None if still_wanted is given and turns false before the request.
+    """
+    key = (round(lat, 5), round(lon, 5))
+    with _address_cache_lock:
+        address = _address_cache.get(key)
+        if address is not None:
+            _address_cache.move_to_end(key)
+            return address
     try:
-        geolocator = Nominatim(user_agent="ev_route_planner_v21")
-        location = geolocator.reverse(f"{lat}, {lon}", timeout=10)
+        if not _wait_for_nominatim_slot(still_wanted):
+            return None
+        with _geolocator_lock:
+            location = _geolocator.reverse(f"{lat}, {lon}", timeout=10)
         if location:
+            with _address_cache_lock:
+                _address_cache[key] = location.address
+                while len(_address_cache) > ADDRESS_CACHE_SIZE:
+                    _address_cache.popitem(last=False)
             return location.address
         return f"{lat:.4f}, {lon:.4f}"
     except:
         return f"{lat:.4f}, {lon:.4f}"
 
 
-def get_route_osrm(start_coords, end_coords):
-    """Get route from OSRM"""
+def get_route_osrm(start_coords, end_coords, base_url=None):
+    """Get route from OSRM (base_url defaults to OSRM_BASE_URL)"""
     try:
-        url = f"http://router.project-osrm.org/route/v1/driving/{start_coords[0]},{start_coords[1]};{end_coords[0]},{end_coords[1]}"
+        url = f"{base_url or OSRM_BASE_URL}/route/v1/driving/{start_coords[0]},{start_coords[1]};{end_coords[0]},{end_coords[1]}"
         params = {'overview': 'full', 'geometries': 'geojson'}
-        response = requests.get(url, params=params, timeout=30)
+        response = _get_osrm_session().get(url, params=params, timeout=30)
         data = response.json()
         if data['code'] == 'Ok' and data['routes']:
             return data['routes'][0]
@@ -44,6 +126,30 @@ def get_route_osrm(start_coords, end_coords):
         return None
 
 
+def warm_osrm_connection(lon, lat):
+    """Open the OSRM keep-alive connection ahead of the real route request"""
+    try:
+        url = f"{OSRM_BASE_URL}/nearest/v1/driving/{lon},{lat}"
+        _get_osrm_session().get(url, timeout=10)
+    except:
+        pass
+
+
+def prefetch_start_point(lat, lon, still_wanted=None):
+    """Speculative work for a freshly clicked start point.
+
+    Reverse-geocodes the start into the address cache and warms the OSRM
+    and Nominatim connections, so the later end click only pays for the end
+    geocode and the route itself. Stops early once still_wanted() is false
+    (the user picked another start).
+    """
+    if still_wanted is not None and not still_wanted():
+        return
+    get_address_from_coords(lat, lon, still_wanted)
+    if still_wanted is None or still_wanted():
+        warm_osrm_connection(lon, lat)
+
+
 def divide_route_into_sections(route_coords, num_sections=3):
     """Divide route into sections"""
     total_points = len(route_coords)
@@ -58,6 +164,621 @@ def divide_route_into_sections(route_coords, num_sections=3):
         sections.append(route_coords[start_idx:end_idx])
     return sections
 
+# --- لقطة مسارات المدن الرئيسية (Hub origin-destination snapshot) ---
+
+# المدن الأكثر استخداماً: (الاسم، خط العرض، خط الطول)
+HUB_CITIES = [
+    ('Riyadh', 24.7136, 46.6753),
+    ('Al Kharj', 24.1556, 47.3122),
+    ('Makkah', 21.3891, 39.8579),
+    ('Jeddah', 21.4858, 39.1925),
+    ('Madinah', 24.4672, 39.6024),
+    ('Dammam', 26.4207, 50.0888),
+]
+HUB_SNAPSHOT_PATH = 'hub_snapshot.bin'
+HUB_SNAP_RADIUS_KM = 15.0
+HUB_CONNECTOR_SPEED_KMH = 40.0 # سرعة تقديرية للوصلة بين النقطة والمدينة
+
+# Layout (all little-endian): header | pad to 8 | hub lat/lon (f64) | distance m (f32, n*n) |
+# duration s (f32, n*n) | geometry offsets (u32, n*n+1) | points lon/lat * 1e5 (i32) | names (utf-8)
+_HUB_SNAPSHOT_MAGIC = b'EVHUB001'
+_HUB_SNAPSHOT_HEADER = struct.Struct('<8sIII') # magic, num_hubs, num_points, names_len
+_HUB_SNAPSHOT_DATA_START = 24
+_HUB_COORD_SCALE = 1e5
+
+_hub_snapshot = None
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def build_hub_snapshot(path=HUB_SNAPSHOT_PATH, hubs=HUB_CITIES, base_url=None,
+                       request_interval=OSRM_PUBLIC_MIN_INTERVAL):
+    """Offline step: route every ordered hub pair through OSRM and write the snapshot file.
+
+    Requests are spaced request_interval seconds apart (the public demo
+    server allows about one per second); point base_url at your own OSRM
+    and pass request_interval=0 for fast builds.
+    """
+    n = len(hubs)
+    last_request = 0.0
+    hub_coords = array('d')
+    distance = array('f')
+    duration = array('f')
+    offsets = array('I', [0])
+    points = array('i')
+    
+    for _, lat, lon in hubs:
+        hub_coords.extend((lat, lon))
+    
+    for i, (name_i, lat_i, lon_i) in enumerate(hubs):
+        for j, (name_j, lat_j, lon_j) in enumerate(hubs):
+            route = None
+            if i != j:
+                delay = request_interval - (time.monotonic() - last_request)
+                if delay > 0:
+                    time.sleep(delay)
+                last_request = time.monotonic()
+                route = get_route_osrm([lon_i, lat_i], [lon_j, lat_j], base_url)
+            if route:
+                distance.append(route['distance'])
+                duration.append(route['duration'])
+                for lon, lat in route['geometry']['coordinates']:
+                    points.append(round(lon * _HUB_COORD_SCALE))
+                    points.append(round(lat * _HUB_COORD_SCALE))
+            else:
+                # NaN = no snapshot answer (same hub, or OSRM failed)
+                distance.append(math.nan)
+                duration.append(math.nan)
+                if i != j:
+                    print(f"⚠️ No route {name_i} -> {name_j}")
+            offsets.append(len(points) // 2)
+    
+    names = '\n'.join(name for name, _, _ in hubs).encode('utf-8')
+    header = _HUB_SNAPSHOT_HEADER.pack(_HUB_SNAPSHOT_MAGIC, n, len(points) // 2, len(names))
+    
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(_HUB_SNAPSHOT_DATA_START, b'\0'))
+        for block in (hub_coords, distance, duration, offsets, points):
+            if sys.byteorder == 'big':
+                block.byteswap()
+            f.write(block.tobytes())
+        f.write(names)
+    os.replace(tmp_path, path)
+    return path
+
+
+class HubSnapshot:
+    """Memory-mapped hub-to-hub route matrix written by build_hub_snapshot.
+
+    Opening only maps the file and slices views over it, so it loads in
+    milliseconds regardless of how much geometry it holds.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # التحقق قبل إنشاء أي memoryview، حتى يمكن إغلاق الـ mmap عند الفشل
+        try:
+            n, num_points, self.names = self._validate(path)
+        except (ValueError, struct.error):
+            self._mmap.close()
+            raise
+        view = memoryview(self._mmap)
+        
+        offset = _HUB_SNAPSHOT_DATA_START
+        def take(count, fmt, itemsize):
+            nonlocal offset
+            raw = view[offset:offset + count * itemsize]
+            offset += count * itemsize
+            if sys.byteorder == 'little':
+                return raw.cast(fmt)
+            block = array(fmt, raw.tobytes()) # (نسخة مقلوبة البايتات على الأجهزة big-endian)
+            block.byteswap()
+            return block
+        
+        self.num_hubs = n
+        self.hub_coords = take(2 * n, 'd', 8)
+        self.distance = take(n * n, 'f', 4)
+        self.duration = take(n * n, 'f', 4)
+        self.geometry_offsets = take(n * n + 1, 'I', 4)
+        self.points = take(2 * num_points, 'i', 4)
+    
+    def _validate(self, path):
+        """Check header, size and consistency; returns (num_hubs, num_points, names)"""
+        magic, n, num_points, names_len = _HUB_SNAPSHOT_HEADER.unpack_from(self._mmap, 0)
+        if magic != _HUB_SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a hub snapshot")
+        
+        # ملف مقطوع أو قديم: الحجم يجب أن يطابق الأعداد في الترويسة بالضبط
+        offsets_start = _HUB_SNAPSHOT_DATA_START + 16 * n + 8 * n * n
+        names_start = offsets_start + 4 * (n * n + 1) + 8 * num_points
+        expected_size = names_start + names_len
+        if len(self._mmap) != expected_size:
+            raise ValueError(f"{path} is {len(self._mmap)} bytes, header expects {expected_size}")
+        
+        names = self._mmap[names_start:expected_size].decode('utf-8').split('\n')
+        (last_offset,) = struct.unpack_from('<I', self._mmap, offsets_start + 4 * n * n)
+        if len(names) != n or last_offset != num_points:
+            raise ValueError(f"{path} is corrupt")
+        return n, num_points, names
+    
+    def nearest_hub(self, lat, lon, radius_km=HUB_SNAP_RADIUS_KM):
+        """(hub index, distance km) of the closest hub within radius_km, or None"""
+        best = None
+        for i in range(self.num_hubs):
+            d = haversine_km(lat, lon, self.hub_coords[2 * i], self.hub_coords[2 * i + 1])
+            if d <= radius_km and (best is None or d < best[1]):
+                best = (i, d)
+        return best
+    
+    def route(self, start_coords, end_coords, radius_km=HUB_SNAP_RADIUS_KM):
+        """OSRM-shaped route between two [lon, lat] points that snap to different hubs, or None"""
+        start_hub = self.nearest_hub(start_coords[1], start_coords[0], radius_km)
+        end_hub = self.nearest_hub(end_coords[1], end_coords[0], radius_km)
+        if start_hub is None or end_hub is None or start_hub[0] == end_hub[0]:
+            return None
+        
+        k = start_hub[0] * self.num_hubs + end_hub[0]
+        distance = self.distance[k]
+        if math.isnan(distance):
+            return None
+        
+        first, last = self.geometry_offsets[k], self.geometry_offsets[k + 1]
+        flat = self.points[2 * first:2 * last].tolist()
+        coordinates = [[flat[p] / _HUB_COORD_SCALE, flat[p + 1] / _HUB_COORD_SCALE]
+                       for p in range(0, len(flat), 2)]
+        
+        # وصلات مستقيمة تقريبية من/إلى مركز المدينة
+        connector_km = start_hub[1] + end_hub[1]
+        if start_hub[1] > 0:
+            coordinates.insert(0, [start_coords[0], start_coords[1]])
+        if end_hub[1] > 0:
+            coordinates.append([end_coords[0], end_coords[1]])
+        
+        return {
+            'geometry': {'coordinates': coordinates},
+            'distance': distance + connector_km * 1000,
+            'duration': self.duration[k] + connector_km / HUB_CONNECTOR_SPEED_KMH * 3600,
+            'hub_names': (self.names[start_hub[0]], self.names[end_hub[0]])
+        }
+
+
+def load_hub_snapshot(path=HUB_SNAPSHOT_PATH):
+    """Load the hub snapshot at startup; planning falls back to OSRM when it is missing"""
+    global _hub_snapshot
+    if not os.path.exists(path):
+        return None
+    try:
+        _hub_snapshot = HubSnapshot(path)
+    except (OSError, ValueError, TypeError, struct.error) as e:
+        print(f"⚠️ Hub snapshot not loaded ({path}): {e}")
+        return None
+    return _hub_snapshot
+
+# --- مسارات متعددة النقاط مع تخزين مؤقت لكل مقطع (Multi-waypoint legs) ---
+
+ROUTE_LEG_CACHE_SIZE = 2048
+
+_route_leg_cache = OrderedDict()
+_route_leg_cache_lock = threading.Lock()
+
+
+def _leg_cache_key(start_coords, end_coords):
+    """Cache key for one leg (OSRM [lon, lat] pairs rounded to ~1 m)"""
+    return (round(start_coords[0], 5), round(start_coords[1], 5),
+            round(end_coords[0], 5), round(end_coords[1], 5))
+
+
+def get_route_leg_cached(start_coords, end_coords):
+    """Get one leg between two waypoints, reusing the leg cache when possible"""
+    key = _leg_cache_key(start_coords, end_coords)
+    with _route_leg_cache_lock:
+        leg = _route_leg_cache.get(key)
+        if leg is not None:
+            _route_leg_cache.move_to_end(key)
+            return leg
+
+    # مدينة رئيسية إلى مدينة رئيسية: من اللقطة بدون أي اتصال بالشبكة
+    route = _hub_snapshot.route(start_coords, end_coords) if _hub_snapshot else None
+    if not route:
+        route = get_route_osrm(start_coords, end_coords)
+    if not route:
+        return None
+
+    leg = {
+        'coordinates': route['geometry']['coordinates'],
+        'distance': route['distance'],
+        'duration': route['duration'],
+        'hub_names': route.get('hub_names') # (فقط للمقاطع المخدومة من اللقطة)
+    }
+    with _route_leg_cache_lock:
+        _route_leg_cache[key] = leg
+        while len(_route_leg_cache) > ROUTE_LEG_CACHE_SIZE:
+            _route_leg_cache.popitem(last=False)
+    return leg
+
+
+def join_route_legs(legs):
+    """Concatenate consecutive legs into a single trip (same shape as route_data)"""
+    coordinates = []
+    for leg in legs:
+        leg_coords = leg['coordinates']
+        # نقطة الوصل مكررة بين نهاية المقطع وبداية التالي
+        if coordinates and leg_coords and coordinates[-1] == leg_coords[0]:
+            leg_coords = leg_coords[1:]
+        coordinates.extend(leg_coords)
+    return {
+        'coordinates': coordinates,
+        'distance': sum(leg['distance'] for leg in legs),
+        'duration': sum(leg['duration'] for leg in legs),
+        'legs': legs,
+        # أسماء المدن عندما يأتي المقطع الأول/الأخير من لقطة المدن
+        'start_hub': legs[0]['hub_names'][0] if legs[0].get('hub_names') else None,
+        'end_hub': legs[-1]['hub_names'][1] if legs[-1].get('hub_names') else None
+    }
+
+
+def get_multi_waypoint_route(waypoints):
+    """Route every consecutive pair of waypoints (OSRM format) and join the legs.
+
+    Only legs missing from the cache hit OSRM, so moving or inserting one
+    waypoint refetches just the one or two legs touching it.
+    """
+    if len(waypoints) < 2:
+        return None
+    legs = []
+    for leg_start, leg_end in zip(waypoints, waypoints[1:]):
+        leg = get_route_leg_cached(leg_start, leg_end)
+        if leg is None:
+            return None
+        legs.append(leg)
+    return join_route_legs(legs)
+
+# --- محاكاة إشغال الشواحن تحت حمل الأسطول (Event-driven charger occupancy) ---
+
+# الأحداث كـ (time, kind, vehicle): عند نفس الوقت تُعالَج كل أحداث FINISH
+# قبل أي ARRIVE (لكل المركبات) حتى تتحرر المنافذ أولاً
+_EVENT_FINISH = 0
+_EVENT_ARRIVE = 1
+
+STATION_SNAP_RADIUS_KM = 5.0
+DEFAULT_STATION_PORTS = 4
+
+
+class StationRegistry:
+    """Charging stations known to the simulator: id -> (name, lat, lon, ports).
+
+    Planned charging points are snapped to the nearest registered station
+    within STATION_SNAP_RADIUS_KM; unknown points become new stations with
+    DEFAULT_STATION_PORTS ports. Use ports=0 for a station under maintenance.
+    Stations are bucketed in a lat/lon grid about one snap radius wide, so a
+    snap only checks the neighbouring cells instead of every station.
+    """
+    
+    def __init__(self, stations=(), snap_radius_km=STATION_SNAP_RADIUS_KM,
+                 default_ports=DEFAULT_STATION_PORTS):
+        self.snap_radius_km = snap_radius_km
+        self.default_ports = default_ports
+        self.cell_deg = snap_radius_km / 111.0 # (درجة عرض ≈ 111 كم)
+        self.grid = {} # (lat cell, lon cell) -> [station ids]
+        self.names = []
+        self.coords = []
+        self.ports = []
+        for station in stations:
+            self.add(station['name'], station['lat'], station['lon'], station.get('ports', default_ports))
+    
+    def add(self, name, lat, lon, ports):
+        """Register a station and return its id"""
+        if ports < 0:
+            raise ValueError(f"station {name!r} has negative ports")
+        station_id = len(self.names)
+        self.names.append(name)
+        self.coords.append((lat, lon))
+        self.ports.append(int(ports))
+        self.grid.setdefault(self._cell(lat, lon), []).append(station_id)
+        return station_id
+    
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+    
+    def snap(self, lat, lon):
+        """Id of the station serving (lat, lon), registering a new one if none is close"""
+        best_id, best_km = None, self.snap_radius_km
+        lat_cell, lon_cell = self._cell(lat, lon)
+        # خلية الطول تضيق مع cos(lat)، فنوسّع البحث شرقاً وغرباً بقدرها
+        lon_span = math.ceil(1 / max(math.cos(math.radians(min(abs(lat) + self.cell_deg, 89.0))), 0.01))
+        for i in range(lat_cell - 1, lat_cell + 2):
+            for j in range(lon_cell - lon_span, lon_cell + lon_span + 1):
+                for station_id in self.grid.get((i, j), ()):
+                    s_lat, s_lon = self.coords[station_id]
+                    d = haversine_km(lat, lon, s_lat, s_lon)
+                    if d <= best_km:
+                        best_id, best_km = station_id, d
+        if best_id is None:
+            best_id = self.add(f"{lat:.4f}, {lon:.4f}", lat, lon, self.default_ports)
+        return best_id
+
+
+def build_trip_stops(route_data, station_ids, charge_minutes=30):
+    """Turn a planned trip into simulator stops.
+
+    Same model as calculate_and_display: the route is split into equal
+    sections with one charging stop between each pair. Returns a list of
+    (station_id, drive_minutes_before_stop, charge_minutes) tuples.
+    """
+    drive_minutes = (route_data['duration'] / 60) / (len(station_ids) + 1)
+    return [(station_id, drive_minutes, charge_minutes) for station_id in station_ids]
+
+
+def planned_trip_stops(route_data, registry, charge_minutes=30):
+    """Simulator stops for a planned route, using its real charging points.
+
+    The charging points are the section ends calculate_and_display marks
+    as محطة A/B; each is snapped to a station in the registry.
+    """
+    sections = divide_route_into_sections(route_data['coordinates'], 3)
+    station_ids = [registry.snap(section[-1][1], section[-1][0]) for section in sections[:-1]]
+    return build_trip_stops(route_data, station_ids, charge_minutes)
+
+
+def simulate_charger_occupancy(trips, station_ports, horizon_min=None):
+    """Replay a batch of trips through the station network (discrete-event).
+
+    trips: list of (depart_minute, stops) with stops from build_trip_stops.
+    station_ports: number of charging ports per station, indexed by station_id.
+    Vehicles queue FIFO when all ports at a station are busy. Vehicles still
+    queued when the simulation ends (e.g. at a 0-port station) are reported
+    as unserved, with their wait counted up to the horizon: the last event
+    or horizon_min, whichever is later.
+    """
+    num_stations = len(station_ports)
+    num_vehicles = len(trips)
+    if any(ports < 0 for ports in station_ports):
+        raise ValueError("station_ports must be >= 0")
+
+    # Stops flattened into arrays; trip v owns stops [trip_first[v], trip_first[v + 1])
+    stop_station = array('i')
+    stop_drive = array('d')
+    stop_charge = array('d')
+    trip_first = array('i', [0])
+    for _, stops in trips:
+        for station_id, drive_minutes, charge_minutes in stops:
+            stop_station.append(station_id)
+            stop_drive.append(drive_minutes)
+            stop_charge.append(charge_minutes)
+        trip_first.append(len(stop_station))
+
+    # Vehicle state
+    vehicle_stop = array('i', trip_first[:num_vehicles])
+    vehicle_arrival = array('d', bytes(8 * num_vehicles))
+    vehicle_wait = array('d', bytes(8 * num_vehicles))
+
+    # Charger state
+    free_ports = array('i', station_ports)
+    busy_minutes = array('d', bytes(8 * num_stations))
+    sessions = array('i', bytes(4 * num_stations))
+    station_wait = array('d', bytes(8 * num_stations))
+    max_queue = array('i', bytes(4 * num_stations))
+    queues = [deque() for _ in range(num_stations)]
+
+    events = []
+    for v, (depart_minute, stops) in enumerate(trips):
+        if stops:
+            events.append((depart_minute + stops[0][1], _EVENT_ARRIVE, v))
+    heapq.heapify(events)
+
+    push = heapq.heappush
+    pop = heapq.heappop
+    now = 0.0
+    while events:
+        now, kind, v = pop(events)
+        s = vehicle_stop[v]
+        st = stop_station[s]
+
+        if kind == _EVENT_ARRIVE:
+            if free_ports[st] > 0:
+                free_ports[st] -= 1
+                push(events, (now + stop_charge[s], _EVENT_FINISH, v))
+            else:
+                vehicle_arrival[v] = now
+                queue = queues[st]
+                queue.append(v)
+                if len(queue) > max_queue[st]:
+                    max_queue[st] = len(queue)
+            continue
+
+        # _EVENT_FINISH: the vehicle leaves, its port goes to the next in line
+        busy_minutes[st] += stop_charge[s]
+        sessions[st] += 1
+        s += 1
+        vehicle_stop[v] = s
+        if s < trip_first[v + 1]:
+            push(events, (now + stop_drive[s], _EVENT_ARRIVE, v))
+
+        queue = queues[st]
+        if queue:
+            w = queue.popleft()
+            wait = now - vehicle_arrival[w]
+            vehicle_wait[w] += wait
+            station_wait[st] += wait
+            push(events, (now + stop_charge[vehicle_stop[w]], _EVENT_FINISH, w))
+        else:
+            free_ports[st] += 1
+
+    horizon = max(now, horizon_min or 0)
+
+    # Vehicles never served: their wait runs until the end of the simulation
+    unserved = array('i', bytes(4 * num_stations))
+    for st, queue in enumerate(queues):
+        unserved[st] = len(queue)
+        for w in queue:
+            wait = horizon - vehicle_arrival[w]
+            vehicle_wait[w] += wait
+            station_wait[st] += wait
+
+    total_sessions = sum(sessions)
+    total_unserved = sum(unserved)
+    total_attempts = total_sessions + total_unserved
+    stations = []
+    for st in range(num_stations):
+        capacity = station_ports[st] * horizon
+        attempts = sessions[st] + unserved[st]
+        stations.append({
+            'station': st,
+            'ports': station_ports[st],
+            'sessions': sessions[st],
+            'unserved': unserved[st],
+            'utilization': busy_minutes[st] / capacity if capacity > 0 else 0,
+            'mean_wait_min': station_wait[st] / attempts if attempts else 0,
+            'max_queue': max_queue[st]
+        })
+
+    return {
+        'vehicles': num_vehicles,
+        'sessions': total_sessions,
+        'unserved': total_unserved,
+        'horizon_min': horizon,
+        # لكل محاولة شحن (جلسة أو انتظار بلا خدمة)
+        'mean_wait_min': sum(station_wait) / total_attempts if total_attempts else 0,
+        # لكل مركبة (مجموع الانتظار في كل محطاتها)
+        'mean_vehicle_wait_min': sum(vehicle_wait) / num_vehicles if num_vehicles else 0,
+        'max_vehicle_wait_min': max(vehicle_wait) if num_vehicles else 0,
+        'stations': stations
+    }
+
+
+def simulate_fleet_plan(trip_requests, registry=None, charge_minutes=30, horizon_min=24 * 60):
+    """Route a batch of planned trips and replay them through the station network.
+
+    trip_requests: list of {'waypoints': [[lat, lon], ...], 'depart_min': float}.
+    Trips that cannot be routed are skipped and counted in 'unrouted'.
+    """
+    registry = registry or StationRegistry()
+    trips = []
+    unrouted = 0
+    for request in trip_requests:
+        route = get_multi_waypoint_route([[lon, lat] for lat, lon in request['waypoints']])
+        if not route:
+            unrouted += 1
+            continue
+        trips.append((request.get('depart_min', 0), planned_trip_stops(route, registry, charge_minutes)))
+    
+    result = simulate_charger_occupancy(trips, registry.ports, horizon_min)
+    result['unrouted'] = unrouted
+    for station in result['stations']:
+        station['name'] = registry.names[station['station']]
+    return result
+
+# --- حسابات الرحلة (V11 Logic، بدون واجهة) ---
+
+DEFAULT_EV_PARAMS = {
+    'start_soc': 90,
+    'battery_capacity': 75,
+    'ev_efficiency': 5.0,
+    'fuel_consumption': 8.0
+}
+
+# الحدود المسموحة (نفس حدود أشرطة التمرير في الواجهة)
+EV_PARAM_RANGES = {
+    'start_soc': (10, 100),
+    'battery_capacity': (20, 150),
+    'ev_efficiency': (2.0, 10.0),
+    'fuel_consumption': (4.0, 20.0)
+}
+
+
+def compute_trip_metrics(route_data, start_address, end_address,
+                         start_soc, battery_capacity, ev_efficiency, fuel_consumption):
+    """Feasibility and cost metrics for a route (V11 logic, no widgets or HTML)"""
+    distance_km = route_data['distance'] / 1000
+    duration_min = route_data['duration'] / 60
+    leg_distance = distance_km / 3
+    
+    total_range = battery_capacity * ev_efficiency
+    current_range = total_range * (start_soc / 100)
+    
+    cp1_status = "operational"
+    cp2_status = "operational"
+    
+    if ("Kharj" in start_address or "خرج" in start_address) and \
+       ("Makkah" in end_address or "مكة" in end_address):
+        cp1_status = "maintenance"
+    
+    trip_possible = True
+    failure_reason = ""
+    
+    if cp1_status == "maintenance":
+        trip_possible = False
+        failure_reason = f"محطة الشحن الأولى ({round(leg_distance,1)} كم) تحت الصيانة"
+    elif current_range < leg_distance:
+        trip_possible = False
+        shortfall = leg_distance - current_range
+        failure_reason = f"لن تصل للمحطة الأولى. ينقصك {round(shortfall, 1)} كم"
+    
+    if trip_possible:
+        current_range = total_range
+        if cp2_status == "maintenance":
+            trip_possible = False
+            failure_reason = "محطة الشحن الثانية تحت الصيانة"
+        elif current_range < leg_distance:
+            trip_possible = False
+            failure_reason = "لن تصل للمحطة الثانية"
+    
+    if trip_possible:
+        current_range = total_range
+        if current_range < leg_distance:
+            trip_possible = False
+            failure_reason = "لن تصل للوجهة النهائية"
+    
+    fuel_cost = (distance_km / 100) * fuel_consumption * 2.33
+    ev_cost = (distance_km / ev_efficiency) * 0.18
+    savings = fuel_cost - ev_cost
+    savings_pct = (savings / fuel_cost * 100) if fuel_cost > 0 else 0
+    
+    return {
+        'distance_km': distance_km,
+        'duration_min': duration_min,
+        'leg_distance_km': leg_distance,
+        'total_range_km': total_range,
+        'cp1_status': cp1_status,
+        'cp2_status': cp2_status,
+        'trip_possible': trip_possible,
+        'failure_reason': failure_reason,
+        'fuel_cost': fuel_cost,
+        'ev_cost': ev_cost,
+        'savings': savings,
+        'savings_pct': savings_pct
+    }
+
+
+def plan_trip(waypoints, params=None):
+    """Plan a trip without any UI; waypoints are [lat, lon] pairs in visiting order.
+
+    Returns the fields colab_js_callback_v21 returns plus the computed metrics.
+    """
+    ev_params = dict(DEFAULT_EV_PARAMS)
+    if params:
+        ev_params.update(params)
+    
+    route = get_multi_waypoint_route([[lon, lat] for lat, lon in waypoints])
+    if not route:
+        return {'status': 'error', 'message': 'Failed to calculate route'}
+    
+    start_address = route['start_hub'] or get_address_from_coords(waypoints[0][0], waypoints[0][1])
+    end_address = route['end_hub'] or get_address_from_coords(waypoints[-1][0], waypoints[-1][1])
+    
+    metrics = compute_trip_metrics(route, start_address, end_address, **ev_params)
+    metrics['num_legs'] = len(route['legs'])
+    return {'status': 'success', 'start': start_address, 'end': end_address, 'metrics': metrics}
+
 # --- الكلاس الرئيسي (من V11) ---
 
 class FullyAutomaticEVPlanner:
@@ -68,12 +789,16 @@ class FullyAutomaticEVPlanner:
         self.end_coords = None
         self.start_address = None
         self.end_address = None
+        self.waypoints = [] # OSRM format [lon, lat], start ... end
+        self.prefetch_threads = {} # (lat, lon) مقربة -> thread
+        self.prefetch_key = None # نقطة البداية الحالية؛ الجلب لأي نقطة أخرى يُلغى
         self.route_data = None
         self.map_widget = None
         
         # EV Parameters with auto-update
         self.start_soc = widgets.FloatSlider(
-            value=90, min=10, max=100, step=5,
+            value=DEFAULT_EV_PARAMS['start_soc'],
+            min=EV_PARAM_RANGES['start_soc'][0], max=EV_PARAM_RANGES['start_soc'][1], step=5,
             description='🔋 شحن البطارية:',
             style={'description_width': '150px'},
             layout=widgets.Layout(width='500px'),
@@ -81,7 +806,8 @@ class FullyAutomaticEVPlanner:
         )
         
         self.battery_capacity = widgets.FloatSlider(
-            value=75, min=20, max=150, step=5,
+            value=DEFAULT_EV_PARAMS['battery_capacity'],
+            min=EV_PARAM_RANGES['battery_capacity'][0], max=EV_PARAM_RANGES['battery_capacity'][1], step=5,
             description='⚡ سعة البطارية (kWh):',
             style={'description_width': '150px'},
             layout=widgets.Layout(width='500px'),
@@ -89,7 +815,8 @@ class FullyAutomaticEVPlanner:
         )
         
         self.ev_efficiency = widgets.FloatSlider(
-            value=5.0, min=2.0, max=10.0, step=0.5,
+            value=DEFAULT_EV_PARAMS['ev_efficiency'],
+            min=EV_PARAM_RANGES['ev_efficiency'][0], max=EV_PARAM_RANGES['ev_efficiency'][1], step=0.5,
             description='📊 الكفاءة (km/kWh):',
             style={'description_width': '150px'},
             layout=widgets.Layout(width='500px'),
@@ -97,7 +824,8 @@ class FullyAutomaticEVPlanner:
         )
         
         self.fuel_consumption = widgets.FloatSlider(
-            value=8.0, min=4.0, max=20.0, step=0.5,
+            value=DEFAULT_EV_PARAMS['fuel_consumption'],
+            min=EV_PARAM_RANGES['fuel_consumption'][0], max=EV_PARAM_RANGES['fuel_consumption'][1], step=0.5,
             description='⛽ استهلاك وقود (L/100km):',
             style={'description_width': '150px'},
             layout=widgets.Layout(width='500px'),
@@ -129,8 +857,29 @@ class FullyAutomaticEVPlanner:
             time.sleep(0.3)
             self.calculate_and_display()
     
+    def prefetch_start(self, lat, lon):
+        """Start background geocoding/warm-up for the start point (called by JS on the start click)"""
+        self.prefetch_threads = {key: thread for key, thread in self.prefetch_threads.items()
+                                 if thread.is_alive()}
+        key = (round(lat, 5), round(lon, 5))
+        self.prefetch_key = key # (الجلب القديم لنقاط أخرى يتوقف قبل طلب Nominatim)
+        if key in self.prefetch_threads:
+            return # نفس النقطة قيد الجلب بالفعل
+        still_wanted = lambda: self.prefetch_key == key
+        thread = threading.Thread(target=prefetch_start_point, args=(lat, lon, still_wanted),
+                                  daemon=True)
+        self.prefetch_threads[key] = thread
+        thread.start()
+    
     def process_route(self, start_lat, start_lon, end_lat, end_lon):
         """Process route automatically (This is the function JS will call)"""
+        return self.process_trip([[start_lat, start_lon], [end_lat, end_lon]])
+    
+    def process_trip(self, waypoints):
+        """Process a multi-stop trip; waypoints are [lat, lon] pairs in visiting order"""
+        
+        if len(waypoints) < 2:
+            return json.dumps({'status': 'error', 'message': 'A trip needs at least two waypoints'})
         
         with self.status_output:
             clear_output(wait=True)
@@ -142,22 +891,13 @@ class FullyAutomaticEVPlanner:
                 </div>
             """))
         
-        self.start_coords = [start_lon, start_lat] # OSRM format
-        self.end_coords = [end_lon, end_lat]     # OSRM format
-        
-        # Get addresses
-        with self.status_output:
-            clear_output(wait=True)
-            display(HTML("""
-                <div style="background: #2196F3; color: white; padding: 15px; border-radius: 10px; 
-                            text-align: center; font-size: 15px; margin: 15px 0;">
-                    📍 جاري جلب العناوين... / Fetching addresses...
-                </div>
-            """))
-        
-        self.start_address = get_address_from_coords(start_lat, start_lon)
-        time.sleep(1) # Respect Nominatim rate limit
-        self.end_address = get_address_from_coords(end_lat, end_lon)
+        # الحالة لا تتغير إلا بعد نجاح حساب المسار
+        previous_waypoints = self.waypoints
+        new_waypoints = [[lon, lat] for lat, lon in waypoints] # OSRM format
+        start_coords = new_waypoints[0]
+        end_coords = new_waypoints[-1]
+        start_address = self.start_address
+        end_address = self.end_address
         
         # Get route
         with self.status_output:
@@ -169,14 +909,46 @@ class FullyAutomaticEVPlanner:
                 </div>
             """))
         
-        route = get_route_osrm(self.start_coords, self.end_coords)
+        route = get_multi_waypoint_route(new_waypoints)
+        
+        # Get addresses (only for endpoints whose leg changed: the address may come
+        # from the hub snapshot, so a new first/last leg can change it too)
+        start_changed = not previous_waypoints or previous_waypoints[:2] != new_waypoints[:2]
+        end_changed = not previous_waypoints or previous_waypoints[-2:] != new_waypoints[-2:]
+        
+        if route and (start_changed or end_changed):
+            with self.status_output:
+                clear_output(wait=True)
+                display(HTML("""
+                    <div style="background: #2196F3; color: white; padding: 15px; border-radius: 10px; 
+                                text-align: center; font-size: 15px; margin: 15px 0;">
+                        📍 جاري جلب العناوين... / Fetching addresses...
+                    </div>
+                """))
+            
+            # انتظار الجلب المسبق لنقطة البداية الحالية فقط بدلاً من تكراره؛
+            # أي جلب لنقطة بداية قديمة يُلغى ولا يحجز دور Nominatim
+            start_key = (round(start_coords[1], 5), round(start_coords[0], 5))
+            current_prefetch = self.prefetch_threads.get(start_key)
+            self.prefetch_key = start_key if current_prefetch else None
+            if current_prefetch:
+                current_prefetch.join(timeout=15)
+            self.prefetch_key = None
+            self.prefetch_threads = {}
+            
+            # مسار من لقطة المدن: اسم المدينة بدون أي اتصال بالشبكة
+            if start_changed:
+                start_address = route['start_hub'] or get_address_from_coords(start_coords[1], start_coords[0])
+            if end_changed: # (get_address_from_coords يحترم حد Nominatim)
+                end_address = route['end_hub'] or get_address_from_coords(end_coords[1], end_coords[0])
         
         if route:
-            self.route_data = {
-                'coordinates': route['geometry']['coordinates'],
-                'distance': route['distance'],
-                'duration': route['duration']
-            }
+            self.waypoints = new_waypoints
+            self.start_coords = start_coords
+            self.end_coords = end_coords
+            self.start_address = start_address
+            self.end_address = end_address
+            self.route_data = route
             
             with self.status_output:
                 clear_output(wait=True)
@@ -199,10 +971,54 @@ class FullyAutomaticEVPlanner:
                         ❌ فشل في حساب المسار / Failed to calculate route
                     </div>
                 """))
+            return json.dumps({'status': 'error', 'message': 'Failed to calculate route'})
         
         # إرجاع نتيجة لـ JS (مهم لـ .then() في JS)
         return json.dumps({'status': 'success', 'start': self.start_address, 'end': self.end_address})
     
+    def _waypoints_latlon(self):
+        """Current waypoints as [lat, lon] pairs"""
+        return [[coord[1], coord[0]] for coord in self.waypoints]
+    
+    def _waypoint_index_error(self, index, upper):
+        """Error JSON (same shape as process_trip) if index is not an integer in [0, upper], else None"""
+        if not self.waypoints:
+            return json.dumps({'status': 'error', 'message': 'No trip planned yet'})
+        # (JS يرسل الأرقام أحياناً كـ float)
+        is_integer = (isinstance(index, int) and not isinstance(index, bool)) or \
+                     (isinstance(index, float) and index.is_integer())
+        if not is_integer or not 0 <= index <= upper:
+            return json.dumps({'status': 'error',
+                               'message': f'Waypoint index must be an integer between 0 and {upper}'})
+        return None
+    
+    def move_waypoint(self, index, lat, lon):
+        """Move one waypoint; only the legs touching it are re-routed"""
+        error = self._waypoint_index_error(index, len(self.waypoints) - 1)
+        if error:
+            return error
+        waypoints = self._waypoints_latlon()
+        waypoints[int(index)] = [lat, lon]
+        return self.process_trip(waypoints)
+    
+    def insert_waypoint(self, index, lat, lon):
+        """Insert a stop before position index; only the split leg is re-routed"""
+        error = self._waypoint_index_error(index, len(self.waypoints))
+        if error:
+            return error
+        waypoints = self._waypoints_latlon()
+        waypoints.insert(int(index), [lat, lon])
+        return self.process_trip(waypoints)
+    
+    def remove_waypoint(self, index):
+        """Remove a stop; only the new joining leg is re-routed"""
+        error = self._waypoint_index_error(index, len(self.waypoints) - 1)
+        if error:
+            return error
+        waypoints = self._waypoints_latlon()
+        del waypoints[int(index)]
+        return self.process_trip(waypoints)
+    
     def calculate_and_display(self):
         """Calculate and display all results (V11 Logic)"""
         
@@ -214,54 +1030,25 @@ class FullyAutomaticEVPlanner:
             clear_output(wait=True)
         
         # (نفس منطق الحسابات والـ HTML من V11)
-        distance_km = self.route_data['distance'] / 1000
-        duration_min = self.route_data['duration'] / 60
+        metrics = compute_trip_metrics(
+            self.route_data, self.start_address, self.end_address,
+            self.start_soc.value, self.battery_capacity.value,
+            self.ev_efficiency.value, self.fuel_consumption.value
+        )
+        distance_km = metrics['distance_km']
+        duration_min = metrics['duration_min']
         duration_hours = duration_min / 60
-        leg_distance = distance_km / 3
-        
-        total_range = self.battery_capacity.value * self.ev_efficiency.value
-        current_range = total_range * (self.start_soc.value / 100)
-        
-        cp1_status = "operational"
-        cp2_status = "operational"
-        cp1_color = "lightblue"
-        cp2_color = "lightblue"
-        
-        if ("Kharj" in self.start_address or "خرج" in self.start_address) and \
-           ("Makkah" in self.end_address or "مكة" in self.end_address):
-            cp1_status = "maintenance"
-            cp1_color = "red"
-        
-        trip_possible = True
-        failure_reason = ""
-        
-        if cp1_status == "maintenance":
-            trip_possible = False
-            failure_reason = f"محطة الشحن الأولى ({round(leg_distance,1)} كم) تحت الصيانة"
-        elif current_range < leg_distance:
-            trip_possible = False
-            shortfall = leg_distance - current_range
-            failure_reason = f"لن تصل للمحطة الأولى. ينقصك {round(shortfall, 1)} كم"
-        
-        if trip_possible:
-            current_range = total_range
-            if cp2_status == "maintenance":
-                trip_possible = False
-                failure_reason = "محطة الشحن الثانية تحت الصيانة"
-            elif current_range < leg_distance:
-                trip_possible = False
-                failure_reason = "لن تصل للمحطة الثانية"
-        
-        if trip_possible:
-            current_range = total_range
-            if current_range < leg_distance:
-                trip_possible = False
-                failure_reason = "لن تصل للوجهة النهائية"
-        
-        fuel_cost = (distance_km / 100) * self.fuel_consumption.value * 2.33
-        ev_cost = (distance_km / self.ev_efficiency.value) * 0.18
-        savings = fuel_cost - ev_cost
-        savings_pct = (savings / fuel_cost * 100) if fuel_cost > 0 else 0
+        leg_distance = metrics['leg_distance_km']
+        cp1_status = metrics['cp1_status']
+        cp2_status = metrics['cp2_status']
+        cp1_color = "red" if cp1_status == "maintenance" else "lightblue"
+        cp2_color = "red" if cp2_status == "maintenance" else "lightblue"
+        trip_possible = metrics['trip_possible']
+        failure_reason = metrics['failure_reason']
+        fuel_cost = metrics['fuel_cost']
+        ev_cost = metrics['ev_cost']
+        savings = metrics['savings']
+        savings_pct = metrics['savings_pct']
         
         if trip_possible:
             status_color = "#27ae60"
@@ -395,7 +1182,16 @@ class FullyAutomaticEVPlanner:
                 tooltip="🏁 الوجهة النهائية",
                 icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
             ).add_to(m)
-            
+
+            # Intermediate stops (multi-waypoint trips)
+            for stop_num, stop in enumerate(self.waypoints[1:-1], start=1):
+                folium.Marker(
+                    [stop[1], stop[0]],
+                    popup=f"<b>📌 توقف {stop_num}</b>",
+                    tooltip=f"📌 توقف {stop_num} / Stop {stop_num}",
+                    icon=folium.Icon(color='orange', icon='map-pin', prefix='fa')
+                ).add_to(m)
+
             # Route sections
             route_coords = self.route_data['coordinates']
             sections = divide_route_into_sections(route_coords, 3)
@@ -432,8 +1228,9 @@ class FullyAutomaticEVPlanner:
                         icon=folium.Icon(color=point_color, icon='bolt', prefix='fa')
                     ).add_to(m)
             
-            m.fit_bounds([[self.start_coords[1], self.start_coords[0]], 
-                         [self.end_coords[1], self.end_coords[0]]])
+            lats = [coord[1] for coord in self.waypoints]
+            lons = [coord[0] for coord in self.waypoints]
+            m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
             
             display(m)
     
@@ -493,6 +1290,12 @@ class FullyAutomaticEVPlanner:
                                box-shadow: 0 4px 12px rgba(244,67,54,0.3); transition: all 0.3s;">
                     🔴 النهاية<br><span style="font-size: 12px;">END</span>
                 </button>
+                <button onclick="setStopMode()" id="stop-btn"
+                        style="grid-column: 1 / span 2; padding: 12px; background: #FF9800; color: white; border: none; 
+                               border-radius: 10px; cursor: pointer; font-weight: bold; font-size: 14px;
+                               box-shadow: 0 4px 12px rgba(255,152,0,0.3); transition: all 0.3s;">
+                    📌 إضافة توقف / ADD STOP
+                </button>
             </div>
             
             <div style="background: #f8f9fa; padding: 14px; border-radius: 10px; margin-bottom: 15px;">
@@ -522,7 +1325,8 @@ class FullyAutomaticEVPlanner:
                 2️⃣ انقر على الخريطة<br>
                 3️⃣ اضغط على "النهاية 🔴"<br>
                 4️⃣ انقر على الخريطة<br>
-                5️⃣ كل شيء آخر تلقائي! ✨
+                5️⃣ كل شيء آخر تلقائي! ✨<br>
+                📌 بعد الرحلة: "إضافة توقف" ثم انقر على الخريطة، اسحب أي علامة لتحريكها، وانقر على التوقف لحذفه
             </div>
         </div>
         
@@ -534,6 +1338,73 @@ class FullyAutomaticEVPlanner:
         var startCoords = null;
         var endCoords = null;
         var mapObj = null;
+        var stopMarkers = []; // التوقفات بالترتيب (waypoint index = i + 1)
+        var tripReady = false; // بعد أول رحلة: التعديلات تعيد حساب المقاطع المتأثرة فقط
+        
+        function callPython(name, args) {
+            return window.parent.google.colab.backend.rpc.call(name, args, {})
+                .then((result) => {
+                    console.log('Python ' + name + ' result (V21):', result);
+                    return result;
+                });
+        }
+        
+        function showProcessing() {
+            document.getElementById('mode-indicator').innerHTML = '✅ تم! جاري معالجة المسار تلقائياً...';
+            document.getElementById('mode-indicator').style.background = '#2196F3';
+        }
+        
+        function setStopMode() {
+            if (!tripReady) {
+                alert('⚠️ حدد البداية والنهاية أولاً!\\nPlease set START and END first!');
+                return;
+            }
+            clickMode = 'stop';
+            document.getElementById('mode-indicator').innerHTML = 
+                '📌 انقر على الخريطة لإضافة توقف قبل الوجهة';
+            document.getElementById('mode-indicator').style.background = '#FF9800';
+            document.getElementById('start-btn').style.transform = 'scale(1)';
+            document.getElementById('end-btn').style.transform = 'scale(1)';
+        }
+        
+        function endIndex() {
+            return stopMarkers.length + 1;
+        }
+        
+        function makeDraggable(marker, getIndex, onMoved) {
+            marker.dragging.enable();
+            marker.on('dragend', function(e) {
+                var p = e.target.getLatLng();
+                onMoved(p);
+                if (tripReady) {
+                    showProcessing();
+                    callPython('pythonMoveWaypointV21', [getIndex(), p.lat, p.lng]);
+                }
+            });
+        }
+        
+        function addStop(lat, lng) {
+            var orangeIcon = L.icon({
+                iconUrl: 'https://raw.githubusercontent.com/pointhi/leaflet-color-markers/master/img/marker-icon-2x-orange.png',
+                shadowUrl: 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.7.1/images/marker-shadow.png',
+                iconSize: [25, 41], iconAnchor: [12, 41], shadowSize: [41, 41]
+            });
+            var index = endIndex(); // قبل الوجهة مباشرة
+            var marker = L.marker([lat, lng], {icon: orangeIcon}).addTo(mapObj)
+                .bindTooltip('📌 توقف / STOP');
+            stopMarkers.push(marker);
+            makeDraggable(marker, () => stopMarkers.indexOf(marker) + 1, () => {});
+            marker.on('click', function() {
+                if (!confirm('حذف هذا التوقف؟ / Remove this stop?')) return;
+                var removeIndex = stopMarkers.indexOf(marker) + 1;
+                stopMarkers.splice(removeIndex - 1, 1);
+                mapObj.removeLayer(marker);
+                showProcessing();
+                callPython('pythonRemoveWaypointV21', [removeIndex]);
+            });
+            showProcessing();
+            callPython('pythonInsertWaypointV21', [index, lat, lng]);
+        }
         
         function setStartMode() {
             clickMode = 'start';
@@ -556,6 +1427,9 @@ class FullyAutomaticEVPlanner:
         function clearAll() {
             if (startMarker) mapObj.removeLayer(startMarker);
             if (endMarker) mapObj.removeLayer(endMarker);
+            stopMarkers.forEach((marker) => mapObj.removeLayer(marker));
+            stopMarkers = [];
+            tripReady = false;
             startCoords = null;
             endCoords = null;
             clickMode = null;
@@ -581,6 +1455,11 @@ class FullyAutomaticEVPlanner:
                 return;
             }
             
+            if (clickMode === 'stop') {
+                addStop(lat, lng);
+                return;
+            }
+            
             if (clickMode === 'start') {
                 startCoords = {lat: lat, lng: lng};
                 if (startMarker) mapObj.removeLayer(startMarker);
@@ -593,12 +1472,30 @@ class FullyAutomaticEVPlanner:
                 
                 startMarker = L.marker([lat, lng], {icon: greenIcon})
                     .addTo(mapObj).bindPopup('🚗 البداية / START').openPopup();
+                makeDraggable(startMarker, () => 0, (p) => { startCoords = {lat: p.lat, lng: p.lng}; });
                 
                 document.getElementById('start-display').innerHTML = 
                     '<div style="font-size: 11px; color: #666; margin-bottom: 4px;">نقطة البداية / START</div>' +
                     '<div style="font-size: 13px; color: #333; font-weight: 500;">📍 ' + 
                     lat.toFixed(5) + ', ' + lng.toFixed(5) + '</div>';
                 
+                // جلب مسبق: ابدأ جلب عنوان البداية وتجهيز الاتصالات فوراً
+                window.parent.google.colab.backend.rpc.call(
+                    'pythonPrefetchV21',
+                    [lat, lng],
+                    {}
+                ).then((result) => {
+                    console.log('Python prefetch result (V21):', result);
+                });
+                
+                if (tripReady) {
+                    // رحلة قائمة: تحريك البداية يعيد حساب المقطع الأول فقط
+                    clickMode = null;
+                    showProcessing();
+                    callPython('pythonMoveWaypointV21', [0, lat, lng]);
+                    return;
+                }
+                
                 setTimeout(() => { if (!endCoords) setEndMode(); }, 600);
                 
             } else if (clickMode === 'end') {
@@ -613,6 +1510,7 @@ class FullyAutomaticEVPlanner:
                 
                 endMarker = L.marker([lat, lng], {icon: redIcon})
                     .addTo(mapObj).bindPopup('🏁 النهاية / END').openPopup();
+                makeDraggable(endMarker, endIndex, (p) => { endCoords = {lat: p.lat, lng: p.lng}; });
                 
                 document.getElementById('end-display').innerHTML = 
                     '<div style="font-size: 11px; color: #666; margin-bottom: 4px;">نقطة النهاية / END</div>' +
@@ -626,6 +1524,12 @@ class FullyAutomaticEVPlanner:
                 document.getElementById('start-btn').style.transform = 'scale(1)';
                 document.getElementById('end-btn').style.transform = 'scale(1)';
                 
+                // رحلة قائمة: تحريك الوجهة يعيد حساب المقطع الأخير فقط
+                if (tripReady) {
+                    callPython('pythonMoveWaypointV21', [endIndex(), lat, lng]);
+                    return;
+                }
+                
                 // Trigger automatic processing
                 if (startCoords && endCoords) {
                     
@@ -637,6 +1541,7 @@ class FullyAutomaticEVPlanner:
                         {} // kwargs
                     ).then((result) => {
                         console.log('Python callback result (V21):', result); 
+                        tripReady = true;
                     });
                     // --- ((((((((((( نهاية الإصلاح ))))))))))) ---
                 }
@@ -724,35 +1629,325 @@ class FullyAutomaticEVPlanner:
         # (حذف زر الإدخال اليدوي من V11)
 
 
+# --- خدمة HTTP مستقلة (Standalone planning service) ---
+
+MAX_REQUEST_BODY = 1024 * 1024
+MAX_HEADER_COUNT = 100
+MAX_HEADER_BYTES = 16 * 1024
+KEEPALIVE_TIMEOUT = 15 # ثوانٍ قبل إغلاق اتصال خامل
+
+
+def _is_json_number(value):
+    """True for JSON numbers only (bool is an int subclass in Python, so exclude it)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _parse_trip_request(request):
+    """Validate one trip request: {'waypoints': [[lat, lon], ...]} or {'start', 'end'}, plus optional 'params'"""
+    if not isinstance(request, dict):
+        raise ValueError("trip must be a JSON object")
+    if 'waypoints' in request:
+        waypoints = request['waypoints']
+    else:
+        waypoints = [request.get('start'), request.get('end')]
+    if not isinstance(waypoints, list) or len(waypoints) < 2:
+        raise ValueError("trip needs 'start' and 'end' or at least two 'waypoints'")
+    parsed = []
+    for point in waypoints:
+        if not isinstance(point, list) or len(point) != 2 or \
+           not (_is_json_number(point[0]) and _is_json_number(point[1])):
+            raise ValueError("waypoints must be [lat, lon] pairs of numbers")
+        lat, lon = float(point[0]), float(point[1])
+        if not (math.isfinite(lat) and math.isfinite(lon)) or \
+           not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"waypoint out of range: [{point[0]}, {point[1]}]")
+        parsed.append([lat, lon])
+    waypoints = parsed
+    
+    params = request.get('params') or {}
+    if not isinstance(params, dict):
+        raise ValueError("'params' must be a JSON object")
+    unknown = set(params) - set(DEFAULT_EV_PARAMS)
+    if unknown:
+        raise ValueError(f"unknown params: {', '.join(sorted(unknown))}")
+    if not all(_is_json_number(value) for value in params.values()):
+        raise ValueError("params must be numbers")
+    params = {name: float(value) for name, value in params.items()}
+    for name, value in params.items():
+        low, high = EV_PARAM_RANGES[name]
+        if not low <= value <= high: # (NaN يفشل هنا أيضاً)
+            raise ValueError(f"'{name}' must be between {low} and {high}")
+    return waypoints, params
+
+
+class EVPlanningService:
+    """Asyncio HTTP front-end for plan_trip, backed by a bounded worker pool.
+
+    Endpoints: GET /health, POST /plan, POST /batch-plan.
+    Route and address caches are module-level, so every worker shares them.
+    """
+    
+    def __init__(self, max_workers=8, max_pending=64):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0 # (يُعدَّل فقط من حلقة asyncio)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='ev-planner')
+    
+    async def serve(self, host='0.0.0.0', port=8000):
+        """Run the HTTP server until cancelled"""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"🚀 EV planning service (V21) on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+    
+    def health(self):
+        """Service and cache status"""
+        return {
+            'status': 'ok',
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'route_cache_size': len(_route_leg_cache),
+            'address_cache_size': len(_address_cache),
+            'hub_snapshot_hubs': _hub_snapshot.num_hubs if _hub_snapshot else 0
+        }
+    
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection (keep-alive supported)"""
+        try:
+            while True:
+                # اتصال keep-alive خامل لا يحجز مهمة إلى الأبد
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                
+                headers = {}
+                header_count = 0
+                header_bytes = 0
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    header_count += 1
+                    header_bytes += len(line)
+                    if header_count > MAX_HEADER_COUNT or header_bytes > MAX_HEADER_BYTES:
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                if header_count > MAX_HEADER_COUNT or header_bytes > MAX_HEADER_BYTES:
+                    await self._send(writer, 431, {'status': 'error',
+                                                   'message': 'Request header fields too large'}, False)
+                    break
+                
+                parts = request_line.decode('latin-1').split()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if len(parts) != 3 or length < 0:
+                    await self._send(writer, 400, {'status': 'error', 'message': 'Bad request'}, False)
+                    break
+                if 'transfer-encoding' in headers:
+                    # لا ندعم chunked: الجسم سيُقرأ كأنه الطلب التالي
+                    await self._send(writer, 411, {'status': 'error',
+                                                   'message': 'Transfer-Encoding not supported; send Content-Length'}, False)
+                    break
+                if length > MAX_REQUEST_BODY:
+                    await self._send(writer, 413, {'status': 'error', 'message': 'Request body too large'}, False)
+                    break
+                
+                method, path, version = parts
+                body = await asyncio.wait_for(reader.readexactly(length), KEEPALIVE_TIMEOUT) if length else b''
+                status, payload = await self.dispatch(method, path.split('?', 1)[0], body)
+                
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    
+    async def dispatch(self, method, path, body):
+        """Route one request; returns (http_status, json_payload)"""
+        if path == '/health':
+            if method != 'GET':
+                return 405, {'status': 'error', 'message': 'Use GET'}
+            return 200, self.health()
+        
+        if path not in ('/plan', '/batch-plan'):
+            return 404, {'status': 'error', 'message': 'Not found'}
+        if method != 'POST':
+            return 405, {'status': 'error', 'message': 'Use POST'}
+        
+        try:
+            request = json.loads(body or b'{}')
+            if path == '/plan':
+                trips = [_parse_trip_request(request)]
+            else:
+                if not isinstance(request, dict) or not isinstance(request.get('trips'), list) \
+                   or not request['trips']:
+                    raise ValueError("'trips' must be a non-empty list")
+                trips = [_parse_trip_request(trip) for trip in request['trips']]
+        except ValueError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+        
+        if len(trips) > self.max_pending:
+            return 413, {'status': 'error',
+                         'message': f"Batch too large: at most {self.max_pending} trips per request"}
+        
+        # Bounded queue: reject instead of piling up work behind the pool
+        if self.pending + len(trips) > self.max_pending:
+            return 503, {'status': 'error', 'message': 'Planner busy, retry later'}
+        
+        self.pending += len(trips)
+        try:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self.executor, plan_trip, waypoints, params)
+                  for waypoints, params in trips),
+                return_exceptions=True
+            )
+        finally:
+            self.pending -= len(trips)
+        
+        results = [{'status': 'error', 'message': str(result)} if isinstance(result, Exception) else result
+                   for result in results]
+        
+        if path == '/plan':
+            result = results[0]
+            return (200 if result['status'] == 'success' else 502), result
+        return 200, {'status': 'success', 'results': results}
+    
+    async def _send(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
 # --- (((( هذا هو كود تشغيل V21 )))) ---
 # --- (يستخدم google.colab.output) ---
 
-print("🚀 جاري تحميل النظام التلقائي الكامل (V21 - V11 Repaired)...")
+load_hub_snapshot()
 
-# 1. إنشاء نسخة من الكلاس
-app = FullyAutomaticEVPlanner()
+# الواجهة فقط داخل دفتر Colab؛ "!python 1.py --..." على Colab يصل إلى سطر الأوامر أدناه
+# (ومن خلية في الدفتر يمكن استدعاء build_hub_snapshot() أو simulate_fleet_plan() مباشرة)
+if output is not None and get_ipython() is not None:
+    print("🚀 جاري تحميل النظام التلقائي الكامل (V21 - V11 Repaired)...")
 
-# 2. تعريف "الدالة الوسيطة"
-def colab_js_callback_v21(startLat, startLon, endLat, endLon):
-    """This function is registered in Colab's kernel and called by JS"""
-    try:
-        # استدعاء الدالة الحقيقية داخل الكائن
-        result_json = app.process_route(startLat, startLon, endLat, endLon)
-        return result_json # إرجاع النتيجة لـ .then() في JS
-    except Exception as e:
-        print(f"Error in callback (V21): {e}") # طباعة الخطأ في بايثون
-        return json.dumps({'status': 'error', 'message': str(e)})
-
-# 3. تسجيل الدالة الوسيطة باستخدام (output.register_callback)
-#    (الاسم يطابق الاسم في JS)
-output.register_callback('pythonCallbackV21', colab_js_callback_v21)
-
-# 4. عرض الواجهة
-app.display()
-
-print("\n" + "="*60)
-print("✅ النظام جاهز بالكامل! (V21) / System Fully Ready!")
-print("="*60)
-print("   هذا هو الكود V11 الأصلي مع إصلاح جسر الاتصال الخاص بـ Colab.")
-print("   الرجاء المحاولة الآن.")
-print("="*60)
+    # 1. إنشاء نسخة من الكلاس
+    app = FullyAutomaticEVPlanner()
+
+    # 2. تعريف "الدالة الوسيطة"
+    def colab_js_callback_v21(startLat, startLon, endLat, endLon):
+        """This function is registered in Colab's kernel and called by JS"""
+        try:
+            # استدعاء الدالة الحقيقية داخل الكائن
+            result_json = app.process_route(startLat, startLon, endLat, endLon)
+            return result_json # إرجاع النتيجة لـ .then() في JS
+        except Exception as e:
+            print(f"Error in callback (V21): {e}") # طباعة الخطأ في بايثون
+            return json.dumps({'status': 'error', 'message': str(e)})
+
+    def colab_js_prefetch_v21(lat, lon):
+        """Called by JS on the start click; returns immediately, work runs in the background"""
+        try:
+            app.prefetch_start(lat, lon)
+            return json.dumps({'status': 'prefetching'})
+        except Exception as e:
+            print(f"Error in prefetch callback (V21): {e}")
+            return json.dumps({'status': 'error', 'message': str(e)})
+
+    # تعديل الرحلة: فقط المقاطع المتأثرة تُعاد من OSRM
+    def colab_js_move_waypoint_v21(index, lat, lon):
+        """Called by JS when a start/stop/end marker is moved"""
+        try:
+            return app.move_waypoint(index, lat, lon)
+        except Exception as e:
+            print(f"Error in move callback (V21): {e}")
+            return json.dumps({'status': 'error', 'message': str(e)})
+
+    def colab_js_insert_waypoint_v21(index, lat, lon):
+        """Called by JS when a stop is added"""
+        try:
+            return app.insert_waypoint(index, lat, lon)
+        except Exception as e:
+            print(f"Error in insert callback (V21): {e}")
+            return json.dumps({'status': 'error', 'message': str(e)})
+
+    def colab_js_remove_waypoint_v21(index):
+        """Called by JS when a stop is removed"""
+        try:
+            return app.remove_waypoint(index)
+        except Exception as e:
+            print(f"Error in remove callback (V21): {e}")
+            return json.dumps({'status': 'error', 'message': str(e)})
+
+    # 3. تسجيل الدالة الوسيطة باستخدام (output.register_callback)
+    #    (الاسم يطابق الاسم في JS)
+    output.register_callback('pythonCallbackV21', colab_js_callback_v21)
+    output.register_callback('pythonPrefetchV21', colab_js_prefetch_v21)
+    output.register_callback('pythonMoveWaypointV21', colab_js_move_waypoint_v21)
+    output.register_callback('pythonInsertWaypointV21', colab_js_insert_waypoint_v21)
+    output.register_callback('pythonRemoveWaypointV21', colab_js_remove_waypoint_v21)
+
+    # 4. عرض الواجهة
+    app.display()
+
+    print("\n" + "="*60)
+    print("✅ النظام جاهز بالكامل! (V21) / System Fully Ready!")
+    print("="*60)
+    print("   هذا هو الكود V11 الأصلي مع إصلاح جسر الاتصال الخاص بـ Colab.")
+    print("   الرجاء المحاولة الآن.")
+    print("="*60)
+
+elif __name__ == '__main__':
+    # خارج الدفتر: خدمة HTTP مستقلة أو أدوات سطر الأوامر
+    parser = argparse.ArgumentParser(description='EV Route Planner HTTP service (V21)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=8, help='planning worker threads')
+    parser.add_argument('--max-pending', type=int, default=64, help='queued trips before returning 503')
+    parser.add_argument('--build-hub-snapshot', action='store_true',
+                        help=f'route all HUB_CITIES pairs into {HUB_SNAPSHOT_PATH} and exit')
+    parser.add_argument('--osrm-url', default=None,
+                        help=f'OSRM server for --build-hub-snapshot (default {OSRM_BASE_URL})')
+    parser.add_argument('--osrm-interval', type=float, default=OSRM_PUBLIC_MIN_INTERVAL,
+                        help='seconds between OSRM requests for --build-hub-snapshot (0 for your own server)')
+    parser.add_argument('--simulate-fleet', metavar='TRIPS_JSON',
+                        help='simulate charger occupancy for a JSON list of planned trips and exit')
+    parser.add_argument('--stations', metavar='STATIONS_JSON',
+                        help='JSON list of {name, lat, lon, ports} stations for --simulate-fleet')
+    parser.add_argument('--charge-minutes', type=float, default=30,
+                        help='charging time per stop for --simulate-fleet')
+    args = parser.parse_args()
+    
+    if args.simulate_fleet:
+        with open(args.simulate_fleet, encoding='utf-8') as f:
+            trip_requests = json.load(f)
+        stations = []
+        if args.stations:
+            with open(args.stations, encoding='utf-8') as f:
+                stations = json.load(f)
+        result = simulate_fleet_plan(trip_requests, StationRegistry(stations), args.charge_minutes)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        raise SystemExit(0)
+    
+    if args.build_hub_snapshot:
+        path = build_hub_snapshot(base_url=args.osrm_url, request_interval=args.osrm_interval)
+        print(f"✅ Hub snapshot written: {path}")
+        raise SystemExit(0)
+    
+    service = EVPlanningService(max_workers=args.workers, max_pending=args.max_pending)
+    asyncio.run(service.serve(args.host, args.port))